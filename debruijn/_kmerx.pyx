@@ -0,0 +1,46 @@
+# distutils: language = c++
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Count the packed k-mers of a fastq file in a single C++ pass.
+
+Build in place with: cythonize -i debruijn/_kmerx.pyx
+"""
+
+import mmap
+import os
+
+from libc.stdint cimport uint32_t, uint64_t
+from libcpp.unordered_map cimport unordered_map
+
+
+def count_kmers(fastq_file, int kmer_size):
+    """Count the packed k-mers of the sequence lines of a fastq file.
+    Nucleotides are packed 2 bits each with (ascii >> 1) & 3, like
+    debruijn.cut_kmer, and the counts are returned as a dict.
+    """
+    cdef unordered_map[uint64_t, uint32_t] counts
+    cdef uint64_t mask = (<uint64_t>1 << (2 * kmer_size)) - 1
+    cdef uint64_t kmer = 0
+    cdef Py_ssize_t i, nb_base = 0
+    cdef int line = 0
+    cdef unsigned char base
+    cdef const unsigned char[:] data
+    with open(fastq_file, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return {}
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            data = mapped
+            with nogil:
+                for i in range(data.shape[0]):
+                    base = data[i]
+                    if base == b"\n":
+                        # Only the second line of each record is a sequence
+                        line = (line + 1) & 3
+                        kmer = 0
+                        nb_base = 0
+                    elif line == 1:
+                        kmer = ((kmer << 2) | ((base >> 1) & 3)) & mask
+                        nb_base += 1
+                        if nb_base >= kmer_size:
+                            counts[kmer] += 1
+            data = None
+    return {pair.first: pair.second for pair in counts}
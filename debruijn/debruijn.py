@@ -14,18 +14,31 @@
 """Perform assembly based on debruijn graph."""
 
 import argparse
+import mmap
 import os
 import sys
+from itertools import islice
 import networkx as nx
-import matplotlib
+import numpy as np
 from operator import itemgetter
 import random
 random.seed(9001)
-from random import randint
-import statistics
-import textwrap
-import matplotlib.pyplot as plt
-matplotlib.use("Agg")
+try:
+    from numba import njit, prange
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+# _kmerx sits next to this file: import it as a sibling module when
+# run as a script, or relative to the debruijn package otherwise
+try:
+    from _kmerx import count_kmers
+    _KMERX_AVAILABLE = True
+except ImportError:
+    try:
+        from ._kmerx import count_kmers
+        _KMERX_AVAILABLE = True
+    except ImportError:
+        _KMERX_AVAILABLE = False
 
 __author__ = "Carolynn Hierso"
 __copyright__ = "Universite Paris Diderot"
@@ -36,6 +49,15 @@ __maintainer__ = "Carolynn Hierso"
 __email__ = "carolynn.hierso@etu.u-paris.fr"
 __status__ = "Developpement"
 
+# Nucleotides indexed by their 2-bit code: (ascii >> 1) & 3 gives
+# A=0, C=1, T=2, G=3 (lower case letters share the same codes)
+NUCLEOTIDES = "ACTG"
+NUCLEOTIDE_ASCII = np.frombuffer(NUCLEOTIDES.encode(), dtype=np.uint8)
+# Number of reads whose k-mers are extracted and counted together
+READ_BATCH_SIZE = 10000
+# Largest k-mer size counted in a dense array of 4**k counts (256 MiB)
+DENSE_KMER_SIZE = 13
+
 def isfile(path):
     """Check if path is an existing file.
       :Parameters:
@@ -50,6 +72,18 @@ def isfile(path):
     return path
 
 
+def iskmersize(value):
+    """Check if the k-mer size fits in a packed 64-bit integer.
+      :Parameters:
+          value: k-mer size
+    """
+    size = int(value)
+    if not 1 <= size <= 31:
+        msg = "{0} is not a k-mer size between 1 and 31".format(value)
+        raise argparse.ArgumentTypeError(msg)
+    return size
+
+
 def get_arguments():
     """Retrieves the arguments of the program.
       Returns: An object that contains the arguments
@@ -60,8 +94,8 @@ def get_arguments():
                                      .format(sys.argv[0]))
     parser.add_argument('-i', dest='fastq_file', type=isfile,
                         required=True, help="Fastq file")
-    parser.add_argument('-k', dest='kmer_size', type=int,
-                        default=22, help="k-mer size (default 22)")
+    parser.add_argument('-k', dest='kmer_size', type=iskmersize,
+                        default=22, help="k-mer size, at most 31 (default 22)")
     parser.add_argument('-o', dest='output_file', type=str,
                         default=os.curdir + os.sep + "contigs.fasta",
                         help="Output contigs in fasta file (default contigs.fasta)")
@@ -71,34 +105,166 @@ def get_arguments():
 
 
 def read_fastq(fastq_file):
-    with open(fastq_file) as file: 
-        for f in file: 
-            yield next(file).strip("\n")
-            next(file)
-            next(file)
+    """Yield the sequence line of each fastq record as bytes.
+    The file is memory-mapped and scanned for newlines, only the
+    sequence lines are copied out.
+    """
+    with open(fastq_file, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # end of the header line
+            end = data.find(b"\n")
+            while end != -1:
+                seq_end = data.find(b"\n", end + 1)
+                if seq_end == -1:
+                    break
+                yield data[end + 1:seq_end]
+                # skip the separator, quality and next header lines
+                end = seq_end
+                for _ in range(3):
+                    end = data.find(b"\n", end + 1)
+                    if end == -1:
+                        break
 
-    
-def cut_kmer(read, kmer_size):
-    for r,_ in enumerate(read[:len(read) - kmer_size + 1]):
-        yield read[r:r+kmer_size]
- 
 
-def build_kmer_dict(fastq_file, kmer_size):
-    dict_kmer={}
-    for file in read_fastq(fastq_file):
-        for kmer in cut_kmer(file, kmer_size):
-            if kmer in dict_kmer.keys(): 
-                dict_kmer[kmer]+=1
-            else : 
-                dict_kmer[kmer]=1
-    return  dict_kmer
- 
+def encode_kmer(kmer):
+    """Pack a nucleotide string into an integer (2 bits per base)."""
+    value = 0
+    for base in kmer:
+        value = (value << 2) | ((ord(base) >> 1) & 3)
+    return value
+
+
+def decode_kmer(value, kmer_size):
+    """Unpack an integer k-mer into its nucleotide string."""
+    return "".join(NUCLEOTIDES[(value >> (2 * (kmer_size - 1 - i))) & 3]
+                   for i in range(kmer_size))
+
+
+def _encode(seq):
+    """Encode a read as an array of 2-bit nucleotide codes."""
+    return (np.frombuffer(seq, dtype=np.uint8) >> 1) & 3
+
+
+def cut_kmer(read, kmer_size):
+    """Return the packed k-mers of a read as an int64 array."""
+    nb_kmer = max(len(read) - kmer_size + 1, 0)
+    if nb_kmer == 0:
+        return np.empty(0, dtype=np.int64)
+    if _NUMBA_AVAILABLE:
+        return cut_kmer_batch([read], kmer_size)
+    enc = _encode(read).astype(np.int64)
+    kmers = np.zeros(nb_kmer, dtype=np.int64)
+    for i in range(kmer_size):
+        kmers = (kmers << 2) | enc[i:i + nb_kmer]
+    return kmers
+
+
+if _NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def extract_kmers(flat, offsets, kmer_size, mask, out, out_offsets):
+        """Pack the k-mers of a batch of ASCII reads, one read per thread.
+        Read r spans flat[offsets[r]:offsets[r+1]] and its k-mers are
+        written to out[out_offsets[r]:out_offsets[r+1]].
+        """
+        for r in prange(offsets.size - 1):
+            start = offsets[r]
+            end = offsets[r + 1]
+            if end - start < kmer_size:
+                continue
+            pos = out_offsets[r]
+            kmer = 0
+            for i in range(start, start + kmer_size):
+                kmer = (kmer << 2) | ((flat[i] >> 1) & 3)
+            out[pos] = kmer
+            for i in range(start + kmer_size, end):
+                kmer = ((kmer << 2) | ((flat[i] >> 1) & 3)) & mask
+                pos += 1
+                out[pos] = kmer
+
+
+def cut_kmer_batch(reads, kmer_size):
+    """Return the packed k-mers of a list of reads as one int64 array."""
+    if not _NUMBA_AVAILABLE:
+        return np.concatenate([cut_kmer(read, kmer_size) for read in reads])
+    lengths = np.fromiter(map(len, reads), dtype=np.int64, count=len(reads))
+    offsets = np.zeros(len(reads) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    out_offsets = np.zeros(len(reads) + 1, dtype=np.int64)
+    np.cumsum(np.maximum(lengths - kmer_size + 1, 0), out=out_offsets[1:])
+    out = np.empty(out_offsets[-1], dtype=np.int64)
+    extract_kmers(np.frombuffer(b"".join(reads), dtype=np.uint8), offsets,
+                  kmer_size, (1 << (2 * kmer_size)) - 1, out, out_offsets)
+    return out
+
+
+def reduce_kmer_counts(values_list, counts_list):
+    """Sum the (k-mer, count) arrays of several batches.
+    Returns the sorted distinct k-mers and their total counts.
+    """
+    values = np.concatenate(values_list)
+    counts = np.concatenate(counts_list)
+    if values.size == 0:
+        return values, counts
+    order = np.argsort(values, kind="stable")
+    values = values[order]
+    starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    return values[starts], np.add.reduceat(counts[order], starts)
 
 
-def build_graph(kmer_dict):
-    digraph = nx.DiGraph()
-    for kmer in kmer_dict: 
-        digraph.add_edge(kmer[:-1], kmer[1:], weight=kmer_dict[kmer])
+def build_kmer_dict(fastq_file, kmer_size):
+    """Count the packed k-mers found in the reads.
+    Up to DENSE_KMER_SIZE, counts are stored in a uint32 array indexed
+    by the packed k-mer, otherwise in a dict keyed by it. Without numba,
+    the compiled _kmerx extension counts the whole file in C++ when it
+    has been built.
+    """
+    if kmer_size <= DENSE_KMER_SIZE:
+        dict_kmer = np.zeros(1 << (2 * kmer_size), dtype=np.uint32)
+    if not _NUMBA_AVAILABLE and _KMERX_AVAILABLE:
+        counts = count_kmers(fastq_file, kmer_size)
+        if kmer_size > DENSE_KMER_SIZE:
+            return counts
+        kmers = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        dict_kmer[kmers] = np.fromiter(counts.values(), dtype=np.uint32,
+                                       count=len(counts))
+        return dict_kmer
+    values_list = [np.empty(0, dtype=np.int64)]
+    counts_list = [np.empty(0, dtype=np.int64)]
+    reads = read_fastq(fastq_file)
+    batch = list(islice(reads, READ_BATCH_SIZE))
+    while batch:
+        kmers = cut_kmer_batch(batch, kmer_size)
+        if kmer_size <= DENSE_KMER_SIZE:
+            np.add.at(dict_kmer, kmers, 1)
+        else:
+            values, counts = np.unique(kmers, return_counts=True)
+            values_list.append(values)
+            counts_list.append(counts)
+        batch = list(islice(reads, READ_BATCH_SIZE))
+    if kmer_size <= DENSE_KMER_SIZE:
+        return dict_kmer
+    values, counts = reduce_kmer_counts(values_list, counts_list)
+    return dict(zip(values.tolist(), counts.tolist()))
+
+
+def build_graph(kmer_dict, kmer_size):
+    """Build the de Bruijn graph of the packed k-mers.
+    kmer_dict maps packed k-mers to their count, or is a dense array of
+    counts as returned by build_kmer_dict. Nodes are the packed (k-1)-mer
+    prefix and suffix of each k-mer.
+    """
+    if isinstance(kmer_dict, np.ndarray):
+        kmers = np.flatnonzero(kmer_dict)
+        kmer_counts = zip(kmers.tolist(), kmer_dict[kmers].tolist())
+    else:
+        kmer_counts = kmer_dict.items()
+    digraph = nx.DiGraph(kmer_size=kmer_size)
+    suffix_mask = (1 << (2 * (kmer_size - 1))) - 1
+    digraph.add_weighted_edges_from(
+        (kmer >> 2, kmer & suffix_mask, weight)
+        for kmer, weight in kmer_counts)
     return digraph
 
     
@@ -117,16 +283,14 @@ def remove_paths(graph, path_list, delete_entry_node, delete_sink_node):
 
 def select_best_path(graph, path_list, path_length, weight_avg_list, 
                      delete_entry_node=False, delete_sink_node=False):
-    if statistics.stdev(weight_avg_list)>0: 
-        del path_list[weight_avg_list.index(max(weight_avg_list))]
-        graph = remove_paths(graph, path_list, delete_entry_node, delete_sink_node)
-    elif statistics.stdev(path_length)>0:
-        del path_list[path_length.index(max(path_length))]
-        graph = remove_paths(graph, path_list, delete_entry_node, delete_sink_node)
+    if max(weight_avg_list) != min(weight_avg_list):
+        best = max(range(len(weight_avg_list)), key=weight_avg_list.__getitem__)
+    elif max(path_length) != min(path_length):
+        best = max(range(len(path_length)), key=path_length.__getitem__)
     else: 
-        random.seed(9001)
-        del path_list[weight_avg_list.index(random.randint(0,len(path_list)))]
-        graph = remove_paths(graph, path_list, delete_entry_node, delete_sink_node)
+        best = random.randrange(len(path_list))
+    del path_list[best]
+    graph = remove_paths(graph, path_list, delete_entry_node, delete_sink_node)
     return graph        
 
 
@@ -134,124 +298,216 @@ def select_best_path(graph, path_list, path_length, weight_avg_list,
 
 def path_average_weight(graph, path):
     """Compute the weight of a path"""
-    return statistics.mean([d["weight"] for (u, v, d) in graph.subgraph(path).edges(data=True)])
+    total = 0
+    for node, next_node in zip(path, path[1:]):
+        total += graph[node][next_node]["weight"]
+    return total / (len(path) - 1)
+
+def simple_paths(graph, source, target, cutoff=None):
+    """Yield the simple paths from source to target, depth first.
+    Visited nodes are kept in a set and paths are built lazily, so
+    callers only needing one path stop after the first branch.
+    """
+    if source == target:
+        return
+    if cutoff is None:
+        cutoff = len(graph) - 1
+    path = [source]
+    visited = {source}
+    stack = [iter(graph.successors(source))]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            visited.discard(path.pop())
+        elif child == target:
+            yield path + [child]
+        elif child not in visited and len(path) < cutoff:
+            path.append(child)
+            visited.add(child)
+            stack.append(iter(graph.successors(child)))
+
 
 def solve_bubble(graph, ancestor_node, descendant_node):
     path_list,path_length,weight_avg_list = [],[],[]
-    for path in nx.all_simple_paths(graph,ancestor_node,descendant_node): 
+    for path in simple_paths(graph, ancestor_node, descendant_node):
         path_list.append(path)
         path_length.append(len(path))
         weight_avg_list.append(path_average_weight(graph, path))
-    graph = select_best_path(graph, path_list, path_length, weight_avg_list, 
-                     delete_entry_node=False, delete_sink_node=False)
+    if len(path_list) > 1:
+        graph = select_best_path(graph, path_list, path_length, weight_avg_list,
+                         delete_entry_node=False, delete_sink_node=False)
     return graph
     
 
 
+def find_bubbles(graph):
+    """Return the (ancestor, descendant) nodes of the bubbles of the graph.
+    The lowest common ancestors of every pair of predecessors are
+    computed in a single pass sharing the ancestor sets.
+    """
+    query_pairs = {}
+    for node in graph.nodes:
+        if graph.in_degree(node) > 1:
+            list_predecessors = list(graph.predecessors(node))
+            for c, i in enumerate(list_predecessors):
+                for j in list_predecessors[c+1:]:
+                    query_pairs.setdefault((i, j), []).append(node)
+    if not query_pairs:
+        return []
+    # Every distinct ancestor is kept: some bubbles cannot be solved
+    ancestors = {}
+    for pair, ancestor_node in nx.all_pairs_lowest_common_ancestor(
+            graph, pairs=query_pairs):
+        for node in query_pairs[pair]:
+            ancestors.setdefault(node, {})[ancestor_node] = None
+    return [(ancestor_node, node) for node in graph.nodes if node in ancestors
+            for ancestor_node in ancestors[node]]
+
+
 def simplify_bubbles(graph):
-    bubble = False 
-    for n in graph.nodes :
-        list_predecessors = list(graph.predecessors(n))
-        if len(list_predecessors)>1:
-            noeud_n = n
-            for c,i in enumerate(list_predecessors):    
-                for j in list_predecessors[c+1:]: 
-                    ancestor_node = nx.lowest_common_ancestor(graph, i, j)
-                    if ancestor_node != None:
-                        bubble = True
-                        break
-        elif bubble : 
+    bubbles = find_bubbles(graph)
+    while bubbles:
+        nb_nodes = graph.number_of_nodes()
+        for ancestor_node, descendant_node in bubbles:
+            # Earlier bubbles of the pass may have removed these nodes
+            if ancestor_node in graph and descendant_node in graph:
+                graph = solve_bubble(graph, ancestor_node, descendant_node)
+        if graph.number_of_nodes() == nb_nodes:
+            # No bubble of the pass removed a node: the others only
+            # have direct edges left to drop and stay
             break
-    if bubble: 
-            graph = simplify_bubbles(solve_bubble(graph,ancestor_node, noeud_n))
-
+        bubbles = find_bubbles(graph)
     return graph
             
+def update_boundary_nodes(graph, boundary_nodes, candidates, degree):
+    """Update in place a list of starting (or sink) nodes after removals.
+    Removed nodes are dropped and the candidates left without any
+    predecessor (or successor), as reported by degree, are appended.
+    """
+    known = set(boundary_nodes)
+    boundary_nodes[:] = [node for node in boundary_nodes if node in graph]
+    for node in dict.fromkeys(candidates):
+        if node not in known and node in graph and degree(node) == 0:
+            boundary_nodes.append(node)
+
+
 def solve_entry_tips(graph, starting_nodes):
-    for node in graph.nodes():
-        path_list,path_length,weight_avg_list= [],[],[]        
+    """Remove the entry tips, starting_nodes is kept up to date in place."""
+    tips = True
+    while tips:
         tips = False
-        list_predecessors = list(graph.predecessors(node))
-        if len(list_predecessors) > 1:
-            for start in starting_nodes:
-                if nx.has_path(graph, start, node):
-                    path = list(nx.all_simple_paths(
-                        graph, start, node))
-                    path_list.append(path[0])
-                    path_length.append(len(path[0]))
-                    weight_avg_list.append(path_average_weight(graph, path[0]))
-                    tips = True
+        # Nodes reachable from each start, computed once per pass
+        descendants = {}
+        for node in graph.nodes():
+            path_list,path_length,weight_avg_list= [],[],[]
+            if graph.in_degree(node) > 1:
+                for start in starting_nodes:
+                    if start not in descendants:
+                        descendants[start] = nx.descendants(graph, start)
+                    if node in descendants[start]:
+                        path = next(simple_paths(graph, start, node))
+                        path_list.append(path)
+                        path_length.append(len(path))
+                        weight_avg_list.append(path_average_weight(graph, path))
+            if len(path_list) > 1:
+                tips = True
+                break
         if tips:
-            break
-    if tips:
-        graph = select_best_path(
-            graph, path_list, path_length, weight_avg_list, delete_entry_node=True)
-        graph = solve_entry_tips(graph, starting_nodes)
+            # Nodes next to the candidate paths may become starting nodes
+            touched = [succ for path in path_list for path_node in path
+                       for succ in graph.successors(path_node)]
+            graph = select_best_path(
+                graph, path_list, path_length, weight_avg_list, delete_entry_node=True)
+            update_boundary_nodes(graph, starting_nodes, touched, graph.in_degree)
     return graph
 
         
-def solve_out_tips(graph, ending_nodes):
-    for node in graph.nodes():
-        path_list,path_length,weight_avg_list= [],[],[]        
+def solve_out_tips(graph, ending_nodes, starting_nodes=None):
+    """Remove the exit tips, ending_nodes is kept up to date in place.
+    Removing a tip can also leave nodes without predecessor: they are
+    appended to starting_nodes when it is given.
+    """
+    tips = True
+    while tips:
         tips = False
-        list_successors = list(graph.successors(node))
-        if len(list_successors) > 1:
-            for end in ending_nodes:
-                if nx.has_path(graph,node,end):
-                    path = list(nx.all_simple_paths(
-                        graph, node,end))
-                    path_list.append(path[0])
-                    path_length.append(len(path[0]))
-                    weight_avg_list.append(path_average_weight(graph, path[0]))
-                    tips = True
-                
+        # Nodes reaching each end, computed once per pass
+        ancestors = {}
+        for node in graph.nodes():
+            path_list,path_length,weight_avg_list= [],[],[]
+            if graph.out_degree(node) > 1:
+                for end in ending_nodes:
+                    if end not in ancestors:
+                        ancestors[end] = nx.ancestors(graph, end)
+                    if node in ancestors[end]:
+                        path = next(simple_paths(graph, node, end))
+                        path_list.append(path)
+                        path_length.append(len(path))
+                        weight_avg_list.append(path_average_weight(graph, path))
+            if len(path_list) > 1:
+                tips = True
+                break
         if tips:
-            break
-    if tips:
-        graph = select_best_path(
-            graph, path_list, path_length, weight_avg_list, delete_sink_node=True)
-        graph = solve_out_tips(graph, ending_nodes)
+            # Nodes next to the candidate paths may become sink nodes
+            touched = [pred for path in path_list for path_node in path
+                       for pred in graph.predecessors(path_node)]
+            # and their successors may become starting nodes
+            touched_succ = [succ for path in path_list for path_node in path
+                            for succ in graph.successors(path_node)]
+            graph = select_best_path(
+                graph, path_list, path_length, weight_avg_list, delete_sink_node=True)
+            update_boundary_nodes(graph, ending_nodes, touched, graph.out_degree)
+            if starting_nodes is not None:
+                update_boundary_nodes(graph, starting_nodes, touched_succ,
+                                      graph.in_degree)
     return graph
 
 def get_starting_nodes(graph):
     first_node=[]
     for n in graph.nodes : 
-        if len(list(graph.predecessors(n)))==0: 
+        if graph.in_degree(n) == 0:
             first_node.append(n)
     return first_node
 
 def get_sink_nodes(graph):
     last_node=[]
     for n in graph.nodes : 
-        if len(list(graph.successors(n)))==0: 
+        if graph.out_degree(n) == 0:
             last_node.append(n)
     return last_node
     
 
 def get_contigs(graph, starting_nodes, ending_nodes):
+    node_size = graph.graph["kmer_size"] - 1
     contigs = []
     for start in starting_nodes : 
+        prefix = decode_kmer(start, node_size).encode()
         for end in ending_nodes : 
          if nx.has_path(graph,start,end):
-            seq=""
-            for path in nx.all_simple_paths(graph,start,end): 
-                seq+=path[0]
-                for kmer in path[1:]: 
-                    seq+=kmer[-1]
+            for path in simple_paths(graph, start, end):
+                # Each following node adds its last nucleotide
+                suffix = NUCLEOTIDE_ASCII[np.array(path[1:]) & 3].tobytes()
+                seq = (prefix + suffix).decode()
                 contigs.append((seq,len(seq)))    
        
     return contigs        
         
        
 def save_contigs(contigs_list, output_file):
-    with open(output_file,"w") as file:
-        for contigs in contigs_list:
-            file.write(">contig_{0} len={1} \n".format(contigs[0],contigs[1]))
-            file.write(textwrap.fill(contigs[0], width=80)+"\n")
+    with open(output_file,"wb") as file:
+        for i, (contig, length) in enumerate(contigs_list):
+            file.write(">contig_{0} len={1}\n".format(i, length).encode())
+            seq = contig.encode()
+            for j in range(0, len(seq), 80):
+                file.write(seq[j:j + 80] + b"\n")
 
 def draw_graph(graph, graphimg_file):
     """Draw the graph
     """                                    
+    # Imported here so that assembly runs never load matplotlib
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots()
     elarge = [(u, v) for (u, v, d) in graph.edges(data=True) if d['weight'] > 3]
     #print(elarge)
@@ -278,19 +534,24 @@ def main():
     """
     # Get arguments
     args = get_arguments()
+    # Compile the k-mer extractor before reading
+    if _NUMBA_AVAILABLE:
+        cut_kmer_batch([b"A"], 1)
     # 1. Lecture du fichier et construction du graphe
     kmer_dict =build_kmer_dict(args.fastq_file,args.kmer_size)
-    graph = build_graph(kmer_dict)
+    graph = build_graph(kmer_dict, args.kmer_size)
 
     # 2. Résolution des bulles
     graph = simplify_bubbles(graph)
 
     # 3. Résolution des pointes d’entrée et de sortie
     
-    graph = solve_entry_tips(graph,get_starting_nodes(graph))
-    graph = solve_out_tips(graph,get_sink_nodes(graph))
+    starting_nodes = get_starting_nodes(graph)
+    graph = solve_entry_tips(graph, starting_nodes)
+    ending_nodes = get_sink_nodes(graph)
+    graph = solve_out_tips(graph, ending_nodes, starting_nodes)
     # 4. Ecriture du/des contigs 
-    contigs = get_contigs(graph,get_starting_nodes(graph),get_sink_nodes(graph))
+    contigs = get_contigs(graph, starting_nodes, ending_nodes)
     save_contigs(contigs,args.output_file)
  
 
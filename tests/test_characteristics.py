@@ -9,6 +9,7 @@ from debruijn import get_starting_nodes
 from debruijn import get_sink_nodes
 from debruijn import get_contigs
 from debruijn import save_contigs
+from debruijn import encode_kmer
 
 
 def test_get_starting_nodes():
@@ -28,9 +29,11 @@ def test_get_sink_nodes():
     assert 7 in nodes
 
 def test_get_contigs():
-    graph = nx.DiGraph()
-    graph.add_edges_from([("TC", "CA"), ("AC", "CA"), ("CA", "AG"), ("AG", "GC"), ("GC", "CG"), ("CG", "GA"), ("GA", "AT"), ("GA", "AA")])
-    contig_list = get_contigs(graph, ["TC", "AC"], ["AT" , "AA"])
+    graph = nx.DiGraph(kmer_size=3)
+    graph.add_edges_from([(encode_kmer(u), encode_kmer(v)) for u, v in
+                          [("TC", "CA"), ("AC", "CA"), ("CA", "AG"), ("AG", "GC"), ("GC", "CG"), ("CG", "GA"), ("GA", "AT"), ("GA", "AA")]])
+    contig_list = get_contigs(graph, [encode_kmer("TC"), encode_kmer("AC")],
+                              [encode_kmer("AT") , encode_kmer("AA")])
     results = ["TCAGCGAT", "TCAGCGAA", "ACAGCGAT", "ACAGCGAA"]
     assert len(contig_list) == 4
     for contig in contig_list:
@@ -1,43 +1,95 @@
 """Tests for graph build"""
 import pytest
+import argparse
 import os
+import subprocess
+import sys
 import networkx as nx
+import numpy as np
 # import pickle
 from .context import debruijn
 #from .context import debruijn_comp
 from debruijn import read_fastq
 from debruijn import cut_kmer
+from debruijn import cut_kmer_batch
 from debruijn import build_kmer_dict
+from debruijn import reduce_kmer_counts
 from debruijn import build_graph
+from debruijn import encode_kmer
+from debruijn import decode_kmer
+from debruijn import iskmersize
 
 
 def test_read_fastq():
     """Test fastq reading"""
     fastq_reader = read_fastq(os.path.abspath(os.path.join(os.path.dirname(__file__), "test_two_reads.fq")))
-    assert next(fastq_reader) == "TCAGAGCTCTAGAGTTGGTTCTGAGAGAGATCGGTTACTCGGAGGAGGCTGTGTCACTCATAGAAGGGATCAATCACACCCACCACGTGTACCGAAACAA"
-    assert next(fastq_reader) == "TTTGAATTACAACATCCATATGTTCTTGATGCTGGAATTCCAATATCTCAGTTGACAGTGTGCCCTCACCAGTGGATCAATTTACGAACCAACAATTGTG"
+    assert next(fastq_reader) == b"TCAGAGCTCTAGAGTTGGTTCTGAGAGAGATCGGTTACTCGGAGGAGGCTGTGTCACTCATAGAAGGGATCAATCACACCCACCACGTGTACCGAAACAA"
+    assert next(fastq_reader) == b"TTTGAATTACAACATCCATATGTTCTTGATGCTGGAATTCCAATATCTCAGTTGACAGTGTGCCCTCACCAGTGGATCAATTTACGAACCAACAATTGTG"
 
 
 def test_cut_kmer():
     """test Kmer cut"""
-    kmer_reader = cut_kmer("TCAGA", 3)
-    assert next(kmer_reader) == "TCA"
-    assert next(kmer_reader) == "CAG"
-    assert next(kmer_reader) == "AGA"
+    kmers = cut_kmer(b"TCAGA", 3)
+    assert len(kmers) == 3
+    assert kmers[0] == encode_kmer("TCA")
+    assert kmers[1] == encode_kmer("CAG")
+    assert kmers[2] == encode_kmer("AGA")
+    assert len(cut_kmer(b"TC", 3)) == 0
+
+
+def test_cut_kmer_batch():
+    """test k-mer cut over several reads"""
+    kmers = cut_kmer_batch([b"TCAGA", b"TC", b"AGAG"], 3)
+    assert list(kmers) == [encode_kmer(kmer) for kmer in
+                           ["TCA", "CAG", "AGA", "AGA", "GAG"]]
+
+
+def test_iskmersize():
+    """test k-mer size check"""
+    assert iskmersize("1") == 1
+    assert iskmersize("31") == 31
+    for value in ["0", "32"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            iskmersize(value)
+
+
+def test_encode_kmer():
+    """test k-mer packing"""
+    assert encode_kmer("ACTG") == 0b00011011
+    assert encode_kmer("acgt") == encode_kmer("ACGT")
+    assert decode_kmer(encode_kmer("TCAGA"), 5) == "TCAGA"
+    assert decode_kmer(encode_kmer("AAC"), 3) == "AAC"
 
 
 def test_build_kmer_dict():
     kmer_dict = build_kmer_dict(os.path.abspath(os.path.join(os.path.dirname(__file__), "test_build.fq")), 3)
-    assert(len(kmer_dict.keys()) == 4)
-    assert "TCA" in kmer_dict
-    assert "CAG" in kmer_dict
-    assert "AGA" in kmer_dict
-    assert "GAG" in kmer_dict
-    assert kmer_dict["AGA"] == 2
+    assert np.count_nonzero(kmer_dict) == 4
+    assert kmer_dict[encode_kmer("TCA")] == 1
+    assert kmer_dict[encode_kmer("CAG")] == 1
+    assert kmer_dict[encode_kmer("AGA")] == 2
+    assert kmer_dict[encode_kmer("GAG")] == 1
+    kmer_dict = build_kmer_dict(os.path.abspath(os.path.join(os.path.dirname(__file__), "test_two_reads.fq")), 21)
+    assert(len(kmer_dict.keys()) == 160)
+    assert encode_kmer("TCAGAGCTCTAGAGTTGGTTC") in kmer_dict
+
+def test_reduce_kmer_counts():
+    values, counts = reduce_kmer_counts([np.array([3, 7]), np.array([5, 7])],
+                                        [np.array([1, 2]), np.array([1, 2])])
+    assert values.tolist() == [3, 5, 7]
+    assert counts.tolist() == [1, 1, 4]
+
+def test_build_kmer_dict_batches(monkeypatch):
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "test_two_reads.fq"))
+    kmer_dict = build_kmer_dict(fastq_file, 21)
+    kmer_counts = build_kmer_dict(fastq_file, 3)
+    monkeypatch.setattr(debruijn, "READ_BATCH_SIZE", 1)
+    assert build_kmer_dict(fastq_file, 21) == kmer_dict
+    assert (build_kmer_dict(fastq_file, 3) == kmer_counts).all()
 
 def test_build_graph():
-    kmer_dict = {'GAG': 1, 'CAG': 1, 'AGA': 2, 'TCA': 1}
-    graph = build_graph(kmer_dict)
+    kmer_dict = {encode_kmer('GAG'): 1, encode_kmer('CAG'): 1,
+                 encode_kmer('AGA'): 2, encode_kmer('TCA'): 1}
+    graph = build_graph(kmer_dict, 3)
     #TCAGAGA
     #TCA  TC CA
     #CAG CA AG
@@ -46,6 +98,53 @@ def test_build_graph():
     #AGA AG GA
     assert graph.number_of_nodes() == 4
     assert graph.number_of_edges() == 4
-    assert "AG" in graph
-    assert "GA" in graph
-    assert graph.edges["AG", "GA"]['weight'] == 2
+    assert encode_kmer("AG") in graph
+    assert encode_kmer("GA") in graph
+    assert graph.edges[encode_kmer("AG"), encode_kmer("GA")]['weight'] == 2
+    kmer_counts = np.zeros(4 ** 3, dtype=np.uint32)
+    for kmer, count in kmer_dict.items():
+        kmer_counts[kmer] = count
+    dense_graph = build_graph(kmer_counts, 3)
+    assert sorted(dense_graph.edges(data="weight")) == sorted(graph.edges(data="weight"))
+
+def test_count_kmers():
+    kmerx = pytest.importorskip("_kmerx")
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "test_build.fq"))
+    assert kmerx.count_kmers(fastq_file, 3) == {
+        encode_kmer("TCA"): 1, encode_kmer("CAG"): 1,
+        encode_kmer("AGA"): 2, encode_kmer("GAG"): 1}
+
+
+def test_build_kmer_dict_kmerx(monkeypatch):
+    """k-mers counted by _kmerx when numba is missing"""
+    if not debruijn._KMERX_AVAILABLE:
+        pytest.skip("_kmerx is not built")
+    calls = []
+    kmerx_count_kmers = debruijn.count_kmers
+    def count_kmers(fastq_file, kmer_size):
+        calls.append(kmer_size)
+        return kmerx_count_kmers(fastq_file, kmer_size)
+    monkeypatch.setattr(debruijn, "_NUMBA_AVAILABLE", False)
+    monkeypatch.setattr(debruijn, "count_kmers", count_kmers)
+    kmer_dict = build_kmer_dict(os.path.abspath(os.path.join(os.path.dirname(__file__), "test_build.fq")), 3)
+    assert isinstance(kmer_dict, np.ndarray)
+    assert np.count_nonzero(kmer_dict) == 4
+    assert kmer_dict[encode_kmer("AGA")] == 2
+    assert kmer_dict[encode_kmer("TCA")] == 1
+    kmer_dict = build_kmer_dict(os.path.abspath(os.path.join(os.path.dirname(__file__), "test_two_reads.fq")), 21)
+    assert isinstance(kmer_dict, dict)
+    assert len(kmer_dict) == 160
+    assert kmer_dict[encode_kmer("TCAGAGCTCTAGAGTTGGTTC")] == 1
+    assert calls == [3, 21]
+
+
+def test_kmerx_package_import():
+    """_kmerx is found when debruijn is imported as a package"""
+    if not debruijn._KMERX_AVAILABLE:
+        pytest.skip("_kmerx is not built")
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    result = subprocess.run(
+        [sys.executable, "-c",
+         "import debruijn.debruijn as m; print(m._KMERX_AVAILABLE)"],
+        cwd=root, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "True"
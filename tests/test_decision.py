@@ -10,6 +10,8 @@ from debruijn import solve_bubble
 from debruijn import simplify_bubbles
 from debruijn import solve_entry_tips
 from debruijn import solve_out_tips
+from debruijn import simple_paths
+from debruijn import find_bubbles
 
 
 
@@ -83,7 +85,18 @@ def test_select_best_path():
     graph_5.add_edges_from([(1, 2), (3, 2), (2, 4), (4, 5), (2, 8), (8, 9),
                             (9, 5), (5, 6), (5, 7)])
     graph_5 = select_best_path(graph_5, [[2, 4, 5], [2, 8, 9, 5]],
-                                         [1, 4], [10, 10])
+                                         [4, 4], [10, 10])
+    assert ((2, 4) in graph_5.edges()) != ((2, 8) in graph_5.edges())
+    assert 2 in graph_5.nodes()
+    assert 5 in graph_5.nodes()
+
+def test_simple_paths():
+    graph = nx.DiGraph()
+    graph.add_edges_from([(1, 2), (2, 4), (1, 3), (3, 4), (4, 2), (4, 5)])
+    paths = list(simple_paths(graph, 1, 5))
+    assert paths == [[1, 2, 4, 5], [1, 3, 4, 5]]
+    assert list(simple_paths(graph, 5, 1)) == []
+    assert list(simple_paths(graph, 1, 5, cutoff=2)) == []
 
 def test_solve_bubble():
     graph_1 = nx.DiGraph()
@@ -119,6 +132,17 @@ def test_solve_bubble():
     assert (9,5) in graph_2.edges()
 
 
+def test_find_bubbles():
+    graph_1 = nx.DiGraph()
+    graph_1.add_edges_from([(3, 2), (2, 4), (4, 5), (2, 8), (8, 9), (9, 5),
+                            (5, 6), (5, 7)])
+    assert find_bubbles(graph_1) == [(2, 5)]
+    graph_1.remove_node(8)
+    assert find_bubbles(graph_1) == []
+    graph_2 = nx.DiGraph()
+    graph_2.add_edges_from([(7, 10), (8, 10), (9, 10), (0, 8), (0, 9), (7, 9)])
+    assert find_bubbles(graph_2) == [(7, 10), (0, 10)]
+
 def test_simplify_bubbles():
     graph_1 = nx.DiGraph()
     graph_1.add_weighted_edges_from([(3, 2, 10), (2, 4, 15), (4, 5, 15),
@@ -131,13 +155,23 @@ def test_simplify_bubbles():
     assert (9,5) not in graph_1.edges()
     assert (2,10) not in graph_1.edges()
     assert (10, 5) not in graph_1.edges()
+    # The bubble 7 -> 10 keeps its direct edge, 0 -> 10 is still solved
+    graph_2 = nx.DiGraph()
+    graph_2.add_weighted_edges_from([(7, 10, 3), (8, 10, 3), (9, 10, 2),
+                                     (0, 8, 3), (0, 9, 3), (7, 9, 5)])
+    graph_2 = simplify_bubbles(graph_2)
+    assert 9 not in graph_2.nodes()
+    assert (0, 8) in graph_2.edges()
+    assert (8, 10) in graph_2.edges()
 
 def test_solve_entry_tips():
     graph_1 = nx.DiGraph()
     graph_1.add_weighted_edges_from([(1, 2, 10), (3, 2, 2), (2, 4, 15), (4, 5, 15)])
-    graph_1 = solve_entry_tips(graph_1, [1, 3])  
+    starting_nodes = [1, 3]
+    graph_1 = solve_entry_tips(graph_1, starting_nodes)
     assert (3, 2) not in graph_1.edges()
     assert (1, 2) in graph_1.edges()
+    assert starting_nodes == [1]
     graph_2 = nx.DiGraph()
     graph_2.add_weighted_edges_from([(1, 2, 2), (6, 3, 2), (3, 2, 2),
                                      (2, 4, 15), (4, 5, 15)])
@@ -149,11 +183,24 @@ def test_solve_entry_tips():
 def test_solve_out_tips():
     graph_1 = nx.DiGraph()
     graph_1.add_weighted_edges_from([(1, 2, 15), (2, 3, 15), (3, 4, 15), (4, 5, 15), (4, 6, 2)])
-    graph_1 = solve_out_tips(graph_1, [5, 6])  
+    ending_nodes = [5, 6]
+    graph_1 = solve_out_tips(graph_1, ending_nodes)
     assert (4, 6) not in graph_1.edges()
     assert (4, 5) in graph_1.edges() 
+    assert ending_nodes == [5]
     graph_2 = nx.DiGraph()
     graph_2.add_weighted_edges_from([(1, 2, 15), (2, 3, 15), (3, 4, 15), (4, 5, 2), (4, 6, 2) , (6, 7, 2)])
     graph_2 = solve_out_tips(graph_2, [5, 7])  
     assert (4, 5) not in graph_2.edges()
     assert (6, 7) in graph_2.edges() 
+    # Removing the tip 2 -> 4 -> 5 leaves 6 without predecessor
+    graph_3 = nx.DiGraph()
+    graph_3.add_weighted_edges_from([(1, 2, 15), (2, 3, 15), (3, 8, 15), (2, 4, 2),
+                                     (4, 5, 2), (4, 6, 2), (6, 3, 2)])
+    starting_nodes = [1]
+    ending_nodes = [8, 5]
+    graph_3 = solve_out_tips(graph_3, ending_nodes, starting_nodes)
+    assert 4 not in graph_3.nodes()
+    assert (6, 3) in graph_3.edges()
+    assert ending_nodes == [8]
+    assert starting_nodes == [1, 6]